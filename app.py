@@ -2,10 +2,15 @@ import streamlit as st
 st.set_page_config(page_title="MetaTone Lab", layout="wide")
 
 import os
+import re
+import html
+import json
+import hashlib
 import subprocess
 import tempfile
 import glob
-import numpy as np
+import logging
+import ollama
 from PIL import Image
 from streamlit_drawable_canvas import st_canvas
 
@@ -14,14 +19,32 @@ YUE_PYTHON   = os.environ.get("YUE_PYTHON",   "python")
 YUE_INFER_PY = os.environ.get("YUE_INFER_PY", "yueForWindows/inference/infer.py")
 YUE_CWD      = os.environ.get("YUE_CWD",      "yueForWindows")
 
+# Environment variables for LLaVA inference ("llama_cpp" or "ollama")
+LLAVA_BACKEND     = os.environ.get("LLAVA_BACKEND",     "llama_cpp")
+LLAVA_GGUF_MODEL  = os.environ.get("LLAVA_GGUF_MODEL",  "models/llava-v1.5-7b-Q4_K_M.gguf")
+LLAVA_GGUF_MMPROJ = os.environ.get("LLAVA_GGUF_MMPROJ", "models/mmproj-model-f16.gguf")
+
+# Decoding limits: ~300 tokens of lyrics plus ~16 for the title; 576 image
+# tokens + prompt + reply fit comfortably in a 2048-token context
+LLAVA_MAX_TOKENS  = 300 + 16
+LLAVA_NUM_CTX     = 2048
+LLAVA_SAMPLING    = {"temperature": 0.3, "top_p": 0.9, "stop": ["[End]", "\n\n\n"]}
+
+logger = logging.getLogger(__name__)
+
 from util.image_helper import create_temp_file
-from util.llm_helper import analyze_image_file, stream_parser
+from util.llm_helper import llava_call
 
 # Store lyrics and title in session state
 if "lyrics" not in st.session_state:
     st.session_state["lyrics"] = None
 if "song_title" not in st.session_state:
     st.session_state["song_title"] = None
+if "lyrics_html" not in st.session_state:
+    st.session_state["lyrics_html"] = None
+# Hash of the canvas the current lyrics were generated from
+if "last_img_hash" not in st.session_state:
+    st.session_state["last_img_hash"] = None
 
 # Page styling
 st.markdown(
@@ -41,10 +64,27 @@ st.markdown(
 )
 st.markdown("<h1>MetaTone Lab</h1>", unsafe_allow_html=True)
 
-# 1) Generate lyrics using LLava:7B
-def generate_lyrics_with_ollama(image: Image.Image) -> str:
-    temp_path = create_temp_file(image)
-    prompt = """
+# Keep one Ollama client alive across Streamlit reruns
+@st.cache_resource
+def get_ollama_client() -> ollama.Client:
+    return ollama.Client()
+
+# Load the Q4_K_M LLaVA GGUF once and keep it resident on the GPU
+@st.cache_resource
+def get_llava_model():
+    from llama_cpp import Llama
+    from llama_cpp.llama_chat_format import Llava15ChatHandler
+    chat_handler = Llava15ChatHandler(clip_model_path=LLAVA_GGUF_MMPROJ, verbose=False)
+    return Llama(
+        model_path=LLAVA_GGUF_MODEL,
+        chat_handler=chat_handler,
+        n_gpu_layers=-1,
+        n_ctx=LLAVA_NUM_CTX,
+        verbose=False
+    )
+
+# Shared prompt for the song title and lyrics
+SONG_PROMPT = """
 You are a creative songwriting assistant.
 Please look at the image I provide and write a structured poetic song inspired by the visual content.
 
@@ -55,29 +95,108 @@ Please look at the image I provide and write a structured poetic song inspired b
 4. Keep lines concise, naturally rhythmic, and easy to sing.
 5. Verses should be introspective and descriptive, while the chorus should be impactful, emotionally intense, and memorable.
 6. Build emotional tension and resolution within the narrative.
+7. Also provide a concise, creative, and poetic song title.
+
+Respond with only a JSON object of the form {"title": "...", "lyrics": "..."}, with no extra words or disclaimers.
 
 Now here is the image:
     """
-    stream = analyze_image_file(image_file=temp_path, model="llava:7b", user_prompt=prompt)
-    parsed = stream_parser(stream)
-    lyrics = "".join(parsed).strip()
-    return lyrics.strip('"')
-
-# 2) Generate song title using LLava:7B
-def generate_song_title(image: Image.Image) -> str:
-    temp_path = create_temp_file(image)
-    prompt = """
-Provide a concise, creative, and poetic song title. Only output the title, with no extra words or disclaimers.
-    """
-    stream = analyze_image_file(image_file=temp_path, model="llava:7b", user_prompt=prompt)
-    parsed = stream_parser(stream)
-    title = "".join(parsed).strip()
-    return title.strip('"')
+
+# 1) Stream song title and lyrics from a single LLaVA-1.5-7B pass
+def stream_title_and_lyrics(image_path: str):
+    if LLAVA_BACKEND == "ollama":
+        backend = {"client": get_ollama_client()}
+    else:
+        backend = {"llm": get_llava_model()}
+    yield from llava_call(image_path, SONG_PROMPT, max_tokens=LLAVA_MAX_TOKENS, num_ctx=LLAVA_NUM_CTX,
+                          **backend, **LLAVA_SAMPLING)
+
+# 2) Parse the model's JSON reply, falling back to a regex if it isn't valid JSON
+def json_string_field(response: str, name: str):
+    # Escaped body of a JSON string field, which may be cut short by the token limit
+    match = re.search(r'"%s"\s*:\s*"((?:[^"\\]|\\.)*)' % name, response)
+    if not match:
+        return None
+    # Drop a \uXXXX escape that was cut off mid-way
+    return re.sub(r'((?:^|[^\\])(?:\\\\)*)\\u[0-9a-fA-F]{0,3}$', r'\1', match.group(1))
+
+def repair_json_escapes(text: str) -> str:
+    # Drop the backslash from escapes JSON doesn't allow, e.g. LLaVA's don\'t
+    return re.sub(r'\\(u[0-9a-fA-F]{4}|["\\/bfnrt])|\\(.?)',
+                  lambda m: "\\" + m.group(1) if m.group(1) else m.group(2), text, flags=re.DOTALL)
+
+def loads_lenient(text: str):
+    # strict=False lets through the raw newlines LLaVA often leaves inside strings
+    try:
+        return json.loads(text, strict=False)
+    except ValueError:
+        return json.loads(repair_json_escapes(text), strict=False)
+
+def decode_json_string(body: str) -> str:
+    return loads_lenient('"' + body + '"')
+
+def lyrics_to_text(value) -> str:
+    # LLaVA sometimes returns the lyrics as a list of lines or a {"Verse 1": ...} object
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list):
+        return "\n".join(text for text in map(lyrics_to_text, value) if text)
+    if isinstance(value, dict):
+        sections = []
+        for key, section in value.items():
+            text = lyrics_to_text(section)
+            if text:
+                sections.append(f"[{str(key).strip('[] ')}]\n{text}")
+        return "\n".join(sections)
+    return ""
+
+def strip_quotes(text: str) -> str:
+    text = text.strip()
+    if len(text) > 1 and text[0] == text[-1] == '"':
+        text = text[1:-1].strip()
+    return text
+
+def parse_title_and_lyrics(response: str) -> dict:
+    response = response.strip()
+    try:
+        data = loads_lenient(response[response.find("{"):response.rfind("}") + 1])
+        if not isinstance(data, dict):
+            raise ValueError("expected a JSON object")
+        title, lyrics = data.get("title"), data.get("lyrics")
+    except ValueError:
+        title, lyrics = json_string_field(response, "title"), json_string_field(response, "lyrics")
+        title = decode_json_string(title) if title is not None else None
+        lyrics = decode_json_string(lyrics) if lyrics is not None else response
+    title = strip_quotes(title) if isinstance(title, str) else ""
+    lyrics = strip_quotes(lyrics_to_text(lyrics))
+    return {"title": title or "Untitled", "lyrics": lyrics}
+
+# Yield only the decoded lyrics as they stream in, collecting the raw reply in `reply`
+def stream_lyrics_preview(tokens, reply: list):
+    shown = ""
+    for token in tokens:
+        reply.append(token)
+        body = json_string_field("".join(reply), "lyrics")
+        if body is None:
+            continue
+        # Decoding is lenient, so the decoded text only ever grows and the
+        # prefix check below holds even after an invalid escape like don\'t
+        lyrics = decode_json_string(body)
+        # Hold back half of a surrogate pair until the other half arrives
+        if lyrics and "\ud800" <= lyrics[-1] <= "\udbff":
+            lyrics = lyrics[:-1]
+        if len(lyrics) > len(shown) and lyrics.startswith(shown):
+            # Markdown needs two trailing spaces for a hard line break
+            yield lyrics[len(shown):].replace("\n", "  \n")
+            shown = lyrics
 
 # 3) Format lyrics for display
 def format_text(text: str) -> str:
-    lines = [line.strip() for line in text.split("\n") if line.strip()]
-    lines = [l[0].upper() + l[1:] if l else "" for l in lines]
+    lines = []
+    for raw in text.splitlines():
+        line = raw.strip()
+        if line:
+            lines.append(line[:1].upper() + line[1:])
     return "\n\n".join(lines)
 
 # 4) Run YuE inference to generate music from text
@@ -120,7 +239,7 @@ def yue_infer(lyrics: str) -> bytes:
             check=True,
             cwd=YUE_CWD
         )
-        st.write("YuE inference output:", result.stdout)
+        logger.debug("YuE inference output:\n%s", result.stdout)
     except subprocess.CalledProcessError as e:
         st.error("YuE inference failed:")
         st.error(e.stderr)
@@ -164,18 +283,38 @@ with col_right:
         if canvas_result.image_data is None:
             st.error("Please sketch something first!")
         else:
-            image = Image.fromarray((canvas_result.image_data * 255).astype(np.uint8)).convert("RGB")
-            title = generate_song_title(image)
-            raw_lyrics = generate_lyrics_with_ollama(image)
-            lyrics = format_text(raw_lyrics)
-            st.session_state["song_title"] = title
-            st.session_state["lyrics"] = lyrics
+            # Skip LLaVA entirely when the canvas is byte-identical to the last run.
+            # Each image gets a single prompt, so a hit never reaches the model and
+            # saving llama-cpp state for reuse would buy nothing
+            img_hash = hashlib.blake2b(canvas_result.image_data.tobytes(), digest_size=16).hexdigest()
+            if img_hash != st.session_state["last_img_hash"] or not st.session_state["lyrics"]:
+                # st_canvas already returns uint8 RGBA in 0-255, so no scaling is needed
+                image = Image.fromarray(canvas_result.image_data).convert("RGB")
+                # LLaVA-1.5's CLIP encoder works at 336x336, so don't ship the full canvas
+                image_path = create_temp_file(image.resize((336, 336), Image.BILINEAR), format="JPEG", quality=90)
+                try:
+                    # Show the lyrics as they arrive, then swap in the formatted version
+                    reply = []
+                    preview = st.empty()
+                    preview.write_stream(stream_lyrics_preview(stream_title_and_lyrics(image_path), reply))
+                    preview.empty()
+                finally:
+                    os.remove(image_path)
+                result = parse_title_and_lyrics("".join(reply))
+                lyrics = format_text(result["lyrics"])
+                if not lyrics:
+                    st.error("LLaVA didn't return any lyrics, please try again.")
+                else:
+                    st.session_state["song_title"] = result["title"]
+                    st.session_state["lyrics"] = lyrics
+                    # Escape model output once here rather than on every rerun
+                    st.session_state["lyrics_html"] = "<br>".join(html.escape(lyrics).splitlines())
+                    st.session_state["last_img_hash"] = img_hash
 
     # Display title and lyrics
     if st.session_state["song_title"] and st.session_state["lyrics"]:
-        st.markdown(f"**Song Title:** {st.session_state['song_title']}", unsafe_allow_html=True)
-        lyrics_html = st.session_state["lyrics"].replace("\n", "<br>")
-        st.markdown(f"<div class='lyrics-container'><p>{lyrics_html}</p></div>", unsafe_allow_html=True)
+        st.markdown(f"**Song Title:** {html.escape(st.session_state['song_title'])}", unsafe_allow_html=True)
+        st.markdown(f"<div class='lyrics-container'><p>{st.session_state['lyrics_html']}</p></div>", unsafe_allow_html=True)
 
     # Generate full song from lyrics
     if st.button("Generate complete song"):
@@ -1,23 +1,36 @@
-import io
 import tempfile
+import numpy as np
 from PIL import Image
 
-def create_temp_file(pil_image: Image.Image) -> str:
+# Optional: libjpeg-turbo via PyTurboJPEG encodes JPEG faster than Pillow
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbojpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _turbojpeg = None
+
+def create_temp_file(pil_image: Image.Image, format: str = "PNG", quality: int = 90) -> str:
     """
-    Saves a PIL Image object to a temporary PNG file and returns the file path.
+    Saves a PIL Image object to a temporary file and returns the file path.
+    Use format="JPEG" for sketches, where lossless encoding isn't needed.
     """
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
-        pil_image.save(tmp, format="PNG")
-        tmp_path = tmp.name
+    if format == "JPEG":
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
+            if _turbojpeg is not None and pil_image.mode == "RGB":
+                tmp.write(_turbojpeg.encode(np.asarray(pil_image), quality=quality, pixel_format=TJPF_RGB))
+            else:
+                pil_image.save(tmp, format="JPEG", quality=quality, optimize=False)
+            tmp_path = tmp.name
+    else:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
+            pil_image.save(tmp, format="PNG")
+            tmp_path = tmp.name
     return tmp_path
 
 def get_image_bytes(image_file: str) -> bytes:
     """
-    Opens the image file at the specified path and returns its byte data.
+    Returns the encoded byte data of the image file at the specified path.
     """
-    image = Image.open(image_file)
-    with io.BytesIO() as output:
-        # Change format to "JPEG" or others as needed
-        image.save(output, format="PNG")
-        image_bytes = output.getvalue()
+    with open(image_file, "rb") as f:
+        image_bytes = f.read()
     return image_bytes
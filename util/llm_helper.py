@@ -2,19 +2,24 @@
 Orignal Author: DevTechBytes
 https://www.youtube.com/@DevTechBytes
 """
+import base64
+import mimetypes
 from ollama import generate
 from util.image_helper import get_image_bytes
 
 system_prompt = f"""You are a helpful chatbot that uses LLMs from Ollama.
                     You can can answer questions about images."""
 
-def analyze_image_file(image_file, model, user_prompt):
+def analyze_image_file(image_file, model, user_prompt, client=None, options=None):
     # gets image bytes using helper function
     image_bytes = get_image_bytes(image_file)
 
-    stream = generate(model=model, 
+    # reuse a persistent client when given, else fall back to the module-level one
+    generate_fn = client.generate if client is not None else generate
+    stream = generate_fn(model=model, 
             prompt=user_prompt, 
             images=[image_bytes], 
+            options=options,
             stream=True)
 
     return stream
@@ -23,3 +28,35 @@ def analyze_image_file(image_file, model, user_prompt):
 def stream_parser(stream):
     for chunk in stream:
         yield chunk['response']
+
+def analyze_image_file_llama_cpp(image_file, llm, user_prompt, **kwargs):
+    # llama-cpp-python takes images as data URIs inside the chat message
+    image_bytes = get_image_bytes(image_file)
+    mime_type = mimetypes.guess_type(image_file)[0] or "image/png"
+    image_url = f"data:{mime_type};base64," + base64.b64encode(image_bytes).decode("ascii")
+
+    stream = llm.create_chat_completion(
+            messages=[{"role": "user", "content": [
+                {"type": "image_url", "image_url": {"url": image_url}},
+                {"type": "text", "text": user_prompt}]}],
+            stream=True,
+            **kwargs)
+
+    return stream
+
+# handles OpenAI-style chat completion chunks from llama-cpp-python
+def chat_stream_parser(stream):
+    for chunk in stream:
+        yield chunk['choices'][0]['delta'].get('content', '')
+
+# runs one LLaVA request on llama-cpp (when llm is given) or Ollama and yields the response text
+def llava_call(image_path, prompt, llm=None, client=None, model="llava:7b", max_tokens=None, num_ctx=None, **sampling):
+    if llm is not None:
+        stream = analyze_image_file_llama_cpp(image_file=image_path, llm=llm, user_prompt=prompt,
+                                              max_tokens=max_tokens, **sampling)
+        return chat_stream_parser(stream)
+
+    options = {"num_predict": max_tokens, "num_ctx": num_ctx, **sampling}
+    stream = analyze_image_file(image_file=image_path, model=model, user_prompt=prompt,
+                                client=client, options=options)
+    return stream_parser(stream)